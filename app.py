@@ -1,15 +1,24 @@
 import os
 import io
 import csv
+import gzip
+import shutil
 import base64
-import datetime
+import time
+import queue
 import threading
+from concurrent.futures import Future
+
+import numpy as np
+import cv2
 
 from flask import Flask, render_template, request, jsonify, send_file, Response
+from markupsafe import escape
 
 # ============== Flask ==============
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 2 * 1024 * 1024  # 2MB
+app.config["MAX_FORM_MEMORY_SIZE"] = 2 * 1024 * 1024  # multipart もメモリ上限を揃える
 
 # ---- CORS（必要なら origins を自分のドメインに絞る）----
 try:
@@ -18,6 +27,22 @@ try:
 except Exception:
     pass
 
+# ---- orjson（あれば jsonify のシリアライズを C 実装に差し替え）----
+try:
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+
+    class _OrjsonProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode("utf-8")
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = _OrjsonProvider(app)
+except Exception:
+    pass
+
 # ============== Paths & Env ==============
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -33,29 +58,150 @@ MODEL_MAP = {
 # Ultralytics/BLAS のスレッド抑制
 os.environ.setdefault("YOLO_CONFIG_DIR", "/tmp/Ultralytics")
 os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("OMP_PLACES", "cores")
+os.environ.setdefault("OMP_PROC_BIND", "close")
 os.environ.setdefault("MKL_NUM_THREADS", "1")
 os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
 os.environ.setdefault("NUMEXPR_NUM_THREADS", "1")
 
 # ============== Model (lazy) ==============
-model = None
+model = None          # Ultralytics フォールバック
+_traced = None        # フォールバック用に trace/freeze した ScriptModule
+_session = None       # onnxruntime.InferenceSession（こちらを優先）
 _loaded_path = None
 _model_lock = threading.Lock()
-_infer_lock = threading.Lock()
+
+# 推論パラメータ（従来の model.predict 引数と同値）
+IMGSZ = 320
+CONF_THRES = 0.45
+IOU_THRES = 0.5
+MAX_DET = 3
+
+# 動的バッチング：リクエストはキューに積み、専用ワーカーが短い窓で束ねて推論する
+MAX_BATCH = 4
+BATCH_WINDOW = 0.005  # 秒
+# 同時に受け付ける /detect の上限。1 件目で弾く旧 _infer_lock と違い、
+# ここまでの並列はキューで待たせ、溢れた分だけ 429 にする。
+MAX_INFLIGHT = 8
+_admit = threading.BoundedSemaphore(MAX_INFLIGHT)
+_infer_q = queue.Queue()
+_batch_buf = np.empty((MAX_BATCH, 3, IMGSZ, IMGSZ), dtype=np.float32)  # ワーカー専用
+
+def _export_onnx(pt_path: str):
+    """
+    .pt の隣に best.onnx を（無ければ）書き出してパスを返す。失敗時は None。
+    """
+    onnx_path = os.path.splitext(pt_path)[0] + ".onnx"
+    if os.path.exists(onnx_path):
+        return onnx_path
+    try:
+        from ultralytics import YOLO
+        YOLO(pt_path).export(format="onnx", imgsz=IMGSZ, simplify=True, opset=13, dynamic=True)
+    except Exception as e:
+        print(f"[WARN] ONNX export failed: {e}")
+        return None
+    return onnx_path if os.path.exists(onnx_path) else None
+
+# INT8 量子化キャリブレーション用の前処理済みフレーム（1x3x320x320）を溜める場所
+CALIB_DIR = os.path.join(BASE_DIR, "logs", "calib")
+CALIB_FRAMES = 50
+
+_calib_count = None  # CALIB_DIR の既存フレーム数。初回だけ listdir で数え、以後はメモリで追う
+
+def _save_calib_frame(x):
+    """キャリブレーション用に前処理済み入力を CALIB_FRAMES 枚までキャッシュする"""
+    global _calib_count
+    if _calib_count is not None and _calib_count >= CALIB_FRAMES:
+        return
+    try:
+        if _calib_count is None:
+            os.makedirs(CALIB_DIR, exist_ok=True)
+            _calib_count = len(os.listdir(CALIB_DIR))
+            if _calib_count >= CALIB_FRAMES:
+                return
+        np.save(os.path.join(CALIB_DIR, f"frame_{_calib_count:03d}.npy"), x)
+        _calib_count += 1
+    except Exception:
+        pass
+
+def _quantize_onnx(onnx_path):
+    """
+    キャリブレーションフレームが溜まっていれば INT8 静的量子化モデル
+    （best.int8.onnx）を作成してパスを返す。無ければ/失敗時は None（FP32 のまま）。
+    """
+    int8_path = os.path.splitext(onnx_path)[0] + ".int8.onnx"
+    if os.path.exists(int8_path):
+        return int8_path
+    try:
+        frames = sorted(os.listdir(CALIB_DIR)) if os.path.isdir(CALIB_DIR) else []
+    except Exception:
+        frames = []
+    if len(frames) < 8:
+        return None
+    try:
+        from onnxruntime.quantization import (
+            CalibrationDataReader, QuantFormat, QuantType, quantize_static,
+        )
+
+        class _Reader(CalibrationDataReader):
+            def __init__(self, paths):
+                self._it = iter(paths)
+
+            def get_next(self):
+                p = next(self._it, None)
+                if p is None:
+                    return None
+                return {"images": np.load(os.path.join(CALIB_DIR, p))}
+
+        quantize_static(
+            model_input=onnx_path,
+            model_output=int8_path,
+            calibration_data_reader=_Reader(frames),
+            quant_format=QuantFormat.QOperator,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+        )
+        print(f"[INFO] INT8 model written: {int8_path}")
+        return int8_path if os.path.exists(int8_path) else None
+    except Exception as e:
+        print(f"[WARN] INT8 quantization failed: {e}")
+        return None
 
 def _ensure_model_loaded(target_path: str) -> bool:
     """
-    指定パスのモデルが未ロード/別物なら読み込む
+    指定パスのモデルが未ロード/別物なら読み込む。
+    ONNX Runtime を優先し（ホットパスから torch を外す）、
+    使えない環境では従来の Ultralytics 経路にフォールバック。
     """
-    global model, _loaded_path
-    if model is not None and _loaded_path == target_path:
+    global model, _traced, _session, _loaded_path
+    if (_session is not None or model is not None) and _loaded_path == target_path:
         return True
     if not os.path.exists(target_path):
         print(f"[WARN] Model not found: {target_path}")
         return False
     with _model_lock:
-        if model is not None and _loaded_path == target_path:
+        if (_session is not None or model is not None) and _loaded_path == target_path:
             return True
+        try:
+            import onnxruntime as ort
+            onnx_path = _export_onnx(target_path)
+            if onnx_path:
+                # INT8 版があれば（または作れれば）そちらを優先
+                serve_path = _quantize_onnx(onnx_path) or onnx_path
+                so = ort.SessionOptions()
+                so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                so.intra_op_num_threads = 1
+                _session = ort.InferenceSession(
+                    serve_path, sess_options=so, providers=["CPUExecutionProvider"]
+                )
+                model = None
+                _traced = None
+                _loaded_path = target_path
+                print(f"[INFO] ONNX session ready: {serve_path}")
+                return True
+        except Exception as e:
+            print(f"[WARN] ONNX Runtime unavailable, falling back to Ultralytics: {e}")
         try:
             from ultralytics import YOLO
             try:
@@ -64,52 +210,388 @@ def _ensure_model_loaded(target_path: str) -> bool:
             except Exception:
                 pass
             m = YOLO(target_path)
+            # CPU 向け最適化：oneDNN + channels_last の trace/freeze 済み
+            # ScriptModule を作れれば、predict() を介さず生出力を
+            # _decode_pred で復号する（ONNX 経路と同じ後処理）。
+            traced = None
+            try:
+                torch.set_flush_denormal(True)
+                torch.backends.mkldnn.enabled = True
+                net = m.model.eval().to(memory_format=torch.channels_last)
+                ex = torch.zeros(1, 3, IMGSZ, IMGSZ).to(memory_format=torch.channels_last)
+                with torch.no_grad():
+                    traced = torch.jit.freeze(torch.jit.trace(net, ex))
+                print("[INFO] TorchScript trace ready")
+            except Exception as e:
+                print(f"[WARN] TorchScript trace failed, using predict(): {e}")
             model = m
+            _traced = traced
+            _session = None
             _loaded_path = target_path
             print(f"[INFO] Model loaded: {_loaded_path}")
             return True
         except Exception as e:
             print(f"[ERROR] Failed to load model: {e}")
             model = None
+            _traced = None
+            _session = None
             _loaded_path = None
             return False
 
+def _nms(xyxy, conf, iou_thres):
+    """クラス非依存の NMS。残すインデックスを conf 降順で返す"""
+    order = conf.argsort()[::-1]
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        if order.size == 1:
+            break
+        rest = order[1:]
+        x1 = np.maximum(xyxy[i, 0], xyxy[rest, 0])
+        y1 = np.maximum(xyxy[i, 1], xyxy[rest, 1])
+        x2 = np.minimum(xyxy[i, 2], xyxy[rest, 2])
+        y2 = np.minimum(xyxy[i, 3], xyxy[rest, 3])
+        inter = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        area_i = (xyxy[i, 2] - xyxy[i, 0]) * (xyxy[i, 3] - xyxy[i, 1])
+        area_r = (xyxy[rest, 2] - xyxy[rest, 0]) * (xyxy[rest, 3] - xyxy[rest, 1])
+        iou = inter / (area_i + area_r - inter + 1e-9)
+        order = rest[iou <= iou_thres]
+    return keep
+
+def _decode_pred(pred, r, dw, dh, src_w, src_h):
+    """
+    YOLO 生出力 (C,N)/(N,C) を [x,y,w,h,cls...] として復号し、
+    conf>=CONF_THRES の上位 MAX_DET 件を検出 dict のリストで返す。
+    r/dw/dh はレターボックスの逆変換（元画像座標へ戻す）に使い、
+    座標は src_w/src_h（元画像の寸法）へクリップする。
+    """
+    p = pred
+    if p.shape[0] < p.shape[1]:
+        p = p.T  # → (N, C)
+    scores = p[:, 4:]
+    conf = scores.max(axis=1)
+    mask = conf >= CONF_THRES
+    if not mask.any():
+        return []
+    p, conf = p[mask], conf[mask]
+    # NMS 前に conf 上位のみへ絞る（候補数を定数に抑える）
+    if conf.size > 30:
+        top = np.argpartition(conf, -30)[-30:]
+        p, conf = p[top], conf[top]
+    cls = p[:, 4:].argmax(axis=1)
+    cx, cy, w, h = p[:, 0], p[:, 1], p[:, 2], p[:, 3]
+    xyxy = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+    keep = _nms(xyxy, conf, IOU_THRES)[:MAX_DET]
+    detections = []
+    for i in keep:
+        x1, y1, x2, y2 = xyxy[i]
+        # パディング部分にかかった枠が負や範囲外の座標にならないようクリップする
+        detections.append({
+            "class_id": int(cls[i]),
+            "confidence": float(conf[i]),
+            "bbox": [
+                float(min(max((x1 - dw) / r, 0.0), src_w)),
+                float(min(max((y1 - dh) / r, 0.0), src_h)),
+                float(min(max((x2 - dw) / r, 0.0), src_w)),
+                float(min(max((y2 - dh) / r, 0.0), src_h)),
+            ],
+        })
+    return detections
+
+_in_u8 = np.empty((IMGSZ, IMGSZ, 3), dtype=np.uint8)  # 前処理の中間バッファ（ワーカー専用）
+
+def _preprocess(img, out):
+    """
+    BGR 画像を 320x320 へレターボックス（アスペクト維持 + 114 パディング）し、
+    RGB float32 CHW で out へ書き込む。検出枠を元画像座標へ戻す・クリップする
+    ための (r, dw, dh, w, h) を返す。リサイズは元寸法 → 320 の 1 回だけ。
+    """
+    h, w = img.shape[:2]
+    r = IMGSZ / max(h, w)
+    if r >= 1.0:
+        # クライアント側で 320 以下に縮小済みのフレームはリサイズ不要（パディングのみ）
+        r = 1.0
+        new_w, new_h = w, h
+        resized = img
+    else:
+        new_w, new_h = int(round(w * r)), int(round(h * r))
+        resized = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    dw, dh = (IMGSZ - new_w) // 2, (IMGSZ - new_h) // 2
+    _in_u8[:] = 114
+    _in_u8[dh:dh + new_h, dw:dw + new_w] = resized
+    cv2.cvtColor(_in_u8, cv2.COLOR_BGR2RGB, dst=_in_u8)
+    # HWC→CHW 転置と 1/255 正規化を 1 パスで済ませる
+    out[...] = cv2.dnn.blobFromImage(_in_u8, scalefactor=1.0 / 255.0, swapRB=False)[0]
+    return r, dw, dh, w, h
+
+def _current_engine():
+    """
+    いま有効な推論エンジンのスナップショット (session, traced, model) を返す。
+    リクエスト時点のエンジンをフレームと一緒にキューへ流すことで、後続の
+    ?model= 切り替えで差し替わったモデルに別リクエストのフレームが
+    流れ込まないようにする（読み出しもロック下で行い、差し替え途中の
+    混成状態を見ない）。
+    """
+    with _model_lock:
+        return (_session, _traced, model)
+
+def _run_batch(batch, engine):
+    """(img, engine, Future, calib) のリストを 1 回の推論にまとめて流し、結果を各 Future へ配る"""
+    session, traced, mdl = engine
+    n = len(batch)
+    scales = [_preprocess(img, _batch_buf[i]) for i, (img, _, _, _) in enumerate(batch)]
+    x = np.ascontiguousarray(_batch_buf[:n])
+    # ウォームアップの合成フレーム（calib=False）はキャリブレーションに入れない
+    ci = next((i for i, it in enumerate(batch) if it[3]), None)
+    if ci is not None:
+        _save_calib_frame(x[ci:ci + 1])
+    if session is not None:
+        try:
+            outs = session.run(None, {"images": x})[0]
+        except Exception:
+            # 静的バッチでエクスポートされた旧 ONNX などは 1 枚ずつ流す
+            outs = np.concatenate(
+                [session.run(None, {"images": x[i:i + 1]})[0] for i in range(n)]
+            )
+        for (_, _, fut, _), out, scale in zip(batch, outs, scales):
+            fut.set_result(_decode_pred(out, *scale))
+    elif traced is not None:
+        import torch
+        with torch.no_grad():
+            t = torch.from_numpy(x).to(memory_format=torch.channels_last)
+            out = traced(t)
+        if isinstance(out, (list, tuple)):
+            out = out[0]
+        outs = out.numpy()
+        for (_, _, fut, _), o, scale in zip(batch, outs, scales):
+            fut.set_result(_decode_pred(o, *scale))
+    else:
+        results = mdl.predict(
+            source=[img for img, _, _, _ in batch],
+            imgsz=IMGSZ,
+            conf=CONF_THRES,
+            iou=IOU_THRES,
+            max_det=MAX_DET,
+            agnostic_nms=True,
+            device="cpu",
+            half=False,
+            retina_masks=False,
+            classes=None,
+            verbose=False,
+            stream=False
+        )
+        for (_, _, fut, _), r in zip(batch, results):
+            # box 毎のスカラー変換ではなく、テンソル → numpy の一括変換で取り出す
+            b = r.boxes
+            cls = b.cls.cpu().numpy()
+            conf = b.conf.cpu().numpy()
+            xyxy = b.xyxy.cpu().numpy()
+            fut.set_result([
+                {"class_id": int(c), "confidence": float(p), "bbox": v.tolist()}
+                for c, p, v in zip(cls, conf, xyxy)
+            ])
+
+def _infer_loop():
+    """推論専用ワーカー。最初の 1 件を取ったら BATCH_WINDOW の間だけ追加を待って束ねる"""
+    # 小さな VM でリクエストスレッドと CPU を取り合わないよう、このスレッドだけ
+    # CPU0 に固定する（Linux 以外では no-op）
+    try:
+        os.sched_setaffinity(0, {0})
+    except (AttributeError, OSError):
+        pass
+    while True:
+        items = [_infer_q.get()]
+        while len(items) < MAX_BATCH:
+            try:
+                items.append(_infer_q.get(timeout=BATCH_WINDOW))
+            except queue.Empty:
+                break
+        # 各フレームは積まれた時点のエンジンで推論する。切り替え直後の窓で
+        # 複数エンジンが混在したら、エンジン毎に分けて流す。
+        groups = {}
+        for it in items:
+            key = tuple(id(e) for e in it[1])
+            groups.setdefault(key, []).append(it)
+        for batch in groups.values():
+            try:
+                _run_batch(batch, batch[0][1])
+            except Exception as e:
+                for _, _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+threading.Thread(target=_infer_loop, daemon=True).start()
+
+def _warmup():
+    """
+    初回リクエストにモデルロード + 初回推論（カーネル選択・ワークスペース確保）の
+    コールドコストを払わせないよう、起動直後にダミーフレームを 1 枚流しておく。
+    """
+    try:
+        if not _ensure_model_loaded(MODEL_PATH):
+            return
+        fut = Future()
+        _infer_q.put((np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8), _current_engine(), fut, False))
+        fut.result(timeout=60)
+        print("[INFO] Warmup inference done")
+    except Exception as e:
+        print(f"[WARN] Warmup failed: {e}")
+
+# Flask 3 には before_first_request が無いため、ワーカープロセス起動時に流す
+threading.Thread(target=_warmup, daemon=True).start()
+
 # ============== Logs ==============
 LOG_DIR = os.path.join(BASE_DIR, "logs")
 os.makedirs(LOG_DIR, exist_ok=True)
 CSV_PATH = os.path.join(LOG_DIR, "detections.csv")
 
+# CSV 追記はリクエストパスから外し、専用スレッドが ~100ms / 64 行単位でまとめて書く。
+# ダウンロード用に事前圧縮した .csv.gz も並行して維持する（gzip は追記で
+# マルチメンバーになるが、展開側は連結として正しく読める）。
+CSV_GZ_PATH = CSV_PATH + ".gz"
+_csv_q = queue.Queue()
+CSV_FLUSH_ROWS = 64
+CSV_FLUSH_SEC = 0.1
+
+def _csv_writer():
+    f = open(CSV_PATH, mode="a", newline="", encoding="utf-8", buffering=1 << 16)
+    w = csv.writer(f)
+    gz_ok = True
+    try:
+        # 起動時に現在の CSV から .gz を作り直す。前回プロセスの kill で
+        # 末尾メンバーが欠けたミラーが残っていても、ここで健全に戻る。
+        if os.path.exists(CSV_PATH):
+            with open(CSV_PATH, "rb") as src, gzip.open(CSV_GZ_PATH, "wb", compresslevel=1) as dst:
+                shutil.copyfileobj(src, dst)
+    except Exception as e:
+        gz_ok = False
+        print(f"[WARN] CSV gzip mirror unavailable: {e}")
+    while True:
+        pending = list(_csv_q.get())
+        try:
+            while len(pending) < CSV_FLUSH_ROWS:
+                pending.extend(_csv_q.get(timeout=CSV_FLUSH_SEC))
+        except queue.Empty:
+            pass
+        try:
+            w.writerows(pending)
+            f.flush()
+            if gz_ok:
+                # バッチ毎に開いて閉じ、メンバー（CRC + 長さのトレーラ込み）を
+                # 完結させる。開きっぱなしの flush ではトレーラが書かれず、
+                # ダウンロードした .gz が展開できない。
+                with gzip.open(CSV_GZ_PATH, "at", newline="", encoding="utf-8",
+                               compresslevel=1) as gz:
+                    csv.writer(gz).writerows(pending)
+        except Exception as e:
+            print(f"[WARN] CSV write failed: {e}")
+
+threading.Thread(target=_csv_writer, daemon=True).start()
+
 def _append_rows(rows):
-    with open(CSV_PATH, mode="a", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        for d in rows:
-            w.writerow([
-                datetime.datetime.now().isoformat(timespec="seconds"),
-                d["class_id"], d["confidence"], *d["bbox"]
-            ])
+    # タイムスタンプは秒精度なのでバッチで 1 回、strftime（C 実装 1 呼び出し）で作る
+    ts = time.strftime("%Y-%m-%dT%H:%M:%S")
+    _csv_q.put_nowait([
+        [ts, d["class_id"], d["confidence"], *d["bbox"]]
+        for d in rows
+    ])
 
 # ============== Utils ==============
+# ---- TurboJPEG（あれば SIMD 版 libjpeg-turbo で JPEG をデコード。無ければ cv2）----
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _tj = TurboJPEG()
+except Exception:
+    _tj = None
+
+def _jpeg_dims(data):
+    """JPEG の SOF マーカーを走査して (width, height) をフルデコードなしで返す。失敗時 None"""
+    try:
+        i = 2
+        n = len(data)
+        while i + 9 < n:
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                i += 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h = (data[i + 5] << 8) | data[i + 6]
+                w = (data[i + 7] << 8) | data[i + 8]
+                return w, h
+            i += 2 + ((data[i + 2] << 8) | data[i + 3])
+        return None
+    except Exception:
+        return None
+
+def _decode_image(img_bytes):
+    """
+    画像バイト列を BGR ndarray へデコードする。JPEG（カメラフレームの常套）は
+    TurboJPEG のスケール付きデコードで推論サイズ（320px）に近いサイズまで
+    一気に縮めて読む。それ以外／TurboJPEG 不在時は cv2.imdecode にフォールバック。
+    """
+    if _tj is not None and img_bytes[:3] == b"\xff\xd8\xff":
+        try:
+            dims = _jpeg_dims(img_bytes)
+            sf = (1, 1)
+            if dims is not None:
+                for den in (8, 4, 2):
+                    if dims[0] // den >= IMGSZ:
+                        sf = (1, den)
+                        break
+            return _tj.decode(img_bytes, pixel_format=TJPF_BGR, scaling_factor=sf)
+        except Exception:
+            pass
+    arr = np.frombuffer(img_bytes, np.uint8)
+    # cv2 経路でも JPEG は IDCT 内の 1/2〜1/8 縮小デコードで無駄な画素を復号しない
+    flag = cv2.IMREAD_COLOR
+    if img_bytes[:3] == b"\xff\xd8\xff":
+        dims = _jpeg_dims(img_bytes)
+        if dims is not None:
+            m0 = max(dims)
+            if m0 // 8 >= IMGSZ:
+                flag = cv2.IMREAD_REDUCED_COLOR_8
+            elif m0 // 4 >= IMGSZ:
+                flag = cv2.IMREAD_REDUCED_COLOR_4
+            elif m0 // 2 >= IMGSZ:
+                flag = cv2.IMREAD_REDUCED_COLOR_2
+    return cv2.imdecode(arr, flag)
+
 def _read_image_bytes():
     # multipart/form-data: 'image' or 'file'
-    if "image" in request.files or "file" in request.files:
+    if request.mimetype.startswith("multipart/"):
         file = request.files.get("image") or request.files.get("file")
-        return file.read()
+        return file.read() if file else None
     # JSON: { "frame": "data:image/jpeg;base64,..." }
-    if request.is_json:
-        data_url = request.json.get("frame")
-        if isinstance(data_url, str) and "base64," in data_url:
-            b64 = data_url.split("base64,", 1)[1]
-            return base64.b64decode(b64)
+    # request.json は ~2MB のボディを丸ごと json.loads するので使わず、
+    # 生ボディから "base64," 以降を直接デコードする（validate=False の
+    # b64decode が JSON の引用符・括弧を読み飛ばしてくれる）。
+    raw = request.get_data(cache=False)
+    idx = raw.find(b"base64,")
+    if idx >= 0:
+        try:
+            return base64.b64decode(raw[idx + 7:])
+        except Exception:
+            return None
     return None
 
+_MODEL_MAP_GET = MODEL_MAP.get
+
 def _resolve_model_path() -> str:
     # ?model=best などを解決。なければ既定。
     name = request.args.get("model") or request.form.get("model")
-    if name and name in MODEL_MAP:
-        return MODEL_MAP[name]
+    if name:
+        return _MODEL_MAP_GET(name, MODEL_PATH)
     return MODEL_PATH
 
 # ============== Routes ==============
+# /csv の 1 行分テンプレート（7 列固定分は % 一発で組み立てる）
+_ROW_FMT = ("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td>"
+            "<td>%s</td><td>%s</td><td>%s</td></tr>").__mod__
+
 @app.route("/")
 def index():
     try:
@@ -125,7 +607,12 @@ def health():
 @app.route("/detect", methods=["POST"])
 @app.route("/api/detect", methods=["POST"])  # ← フロント互換のため追加
 def detect():
-    if not _infer_lock.acquire(blocking=False):
+    # ボディをバッファする前に、宣言サイズの時点で過大なリクエストを弾く
+    cl = request.content_length
+    if cl and cl > app.config["MAX_CONTENT_LENGTH"]:
+        return jsonify({"error": "payload too large"}), 413
+    # 受付制御：待ち行列が MAX_INFLIGHT を超えたときだけ 429 を返す
+    if not _admit.acquire(blocking=False):
         return jsonify({"error": "busy"}), 429
     try:
         target_model_path = _resolve_model_path()
@@ -136,65 +623,38 @@ def detect():
         if not img_bytes:
             return jsonify({"error": "No image provided"}), 400
 
-        import numpy as np
-        import cv2
-        arr = np.frombuffer(img_bytes, np.uint8)
-        img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+        img = _decode_image(img_bytes)
         if img is None:
             return jsonify({"error": "Failed to decode image"}), 400
 
-        # 幅480pxへ縮小
-        target_w = 480
-        h, w = img.shape[:2]
-        if w > target_w:
-            scale = target_w / float(w)
-            img = cv2.resize(img, (target_w, int(h * scale)), interpolation=cv2.INTER_AREA)
-
+        fut = Future()
+        _infer_q.put((img, _current_engine(), fut, True))
         try:
-            results = model.predict(
-                source=img,
-                imgsz=320,
-                conf=0.45,
-                iou=0.5,
-                max_det=3,
-                agnostic_nms=True,
-                device="cpu",
-                half=False,
-                retina_masks=False,
-                classes=None,
-                verbose=False,
-                stream=False
-            )
+            detections = fut.result(timeout=5)
         except Exception as e:
             return jsonify({"error": f"inference failed: {e}"}), 500
 
-        detections = []
-        try:
-            for r in results:
-                for box in r.boxes:
-                    cls_id = int(box.cls[0])
-                    conf = float(box.conf[0])
-                    xyxy = [float(x) for x in box.xyxy[0].tolist()]
-                    detections.append({"class_id": cls_id, "confidence": conf, "bbox": xyxy})
-        except Exception as e:
-            return jsonify({"error": f"parse failed: {e}"}), 500
-
         if detections:
             _append_rows(detections)
 
         return jsonify(detections)
     finally:
-        _infer_lock.release()
+        _admit.release()
 
 @app.route("/csv")
 def csv_view():
-    from collections import deque
-    rows = deque(maxlen=200)
+    rows = []
     if os.path.exists(CSV_PATH):
-        with open(CSV_PATH, newline="", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            for row in reader:
-                rows.append(row)
+        # 末尾 64KB だけ読んで最新 200 行を取り出す（古い行を全走査しない）
+        size = os.path.getsize(CSV_PATH)
+        with open(CSV_PATH, "rb") as f:
+            if size > 65536:
+                f.seek(size - 65536)
+                tail = f.read().split(b"\n", 1)[-1]  # 先頭の欠け行を捨てる
+            else:
+                tail = f.read()
+        lines = tail.decode("utf-8", errors="replace").splitlines()[-200:]
+        rows = list(csv.reader(lines))
     html = [
         "<html><head><meta charset='utf-8'><title>detections.csv (tail 200)</title>",
         "<style>table{border-collapse:collapse}td,th{border:1px solid #ccc;padding:4px 8px}</style>",
@@ -205,7 +665,11 @@ def csv_view():
         "<tr><th>time</th><th>class_id</th><th>confidence</th><th>x1</th><th>y1</th><th>x2</th><th>y2</th></tr>"
     ]
     for row in rows:
-        html.append("<tr>" + "".join(f"<td>{c}</td>" for c in row) + "</tr>")
+        cells = tuple(map(escape, row))
+        if len(cells) == 7:
+            html.append(_ROW_FMT(cells))
+        else:
+            html.append("<tr>%s</tr>" % "".join("<td>%s</td>" % c for c in cells))
     html += ["</table>", "</body></html>"]
     return Response("\n".join(html), mimetype="text/html")
 
@@ -218,6 +682,12 @@ def csv_download():
         buf.seek(0)
         return Response(buf.read(), mimetype="text/csv",
                         headers={"Content-Disposition": "attachment; filename=detections.csv"})
+    # gzip を受けられるクライアントには事前圧縮済みファイルを sendfile で返す
+    if os.path.exists(CSV_GZ_PATH) and "gzip" in request.accept_encodings:
+        resp = send_file(CSV_GZ_PATH, mimetype="text/csv",
+                         as_attachment=True, download_name="detections.csv")
+        resp.headers["Content-Encoding"] = "gzip"
+        return resp
     return send_file(CSV_PATH, mimetype="text/csv", as_attachment=True)
 
 if __name__ == "__main__":